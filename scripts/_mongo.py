@@ -0,0 +1,45 @@
+"""
+Shared MongoDB Connection
+Caches a single MongoClient per process so every MongoDBClient reuses
+the same pool, TLS session and authentication handshake
+"""
+
+import os
+from typing import Optional
+
+from pymongo import MongoClient
+
+URI_SCHEMES = ('mongodb://', 'mongodb+srv://')
+
+_client: Optional[MongoClient] = None
+
+
+def is_valid_uri(uri: Optional[str]) -> bool:
+    """True when uri is set and uses a MongoDB connection-string scheme"""
+    return bool(uri) and uri.startswith(URI_SCHEMES)
+
+
+def get_client(uri: Optional[str] = None) -> MongoClient:
+    """Return the process-wide MongoClient, connecting and pinging on first use"""
+    global _client
+    if _client is None:
+        uri = uri or os.environ['MONGODB_URI']
+        if not is_valid_uri(uri):
+            raise ValueError(f"MONGODB_URI must start with {' or '.join(URI_SCHEMES)}")
+        client = MongoClient(
+            uri,
+            compressors='zstd,zlib',  # zstd when available, zlib otherwise
+            maxPoolSize=20,
+            retryWrites=True
+        )
+        client.admin.command('ping')
+        _client = client
+    return _client
+
+
+def close_client():
+    """Close the shared client (a later get_client() reconnects)"""
+    global _client
+    if _client is not None:
+        _client.close()
+        _client = None
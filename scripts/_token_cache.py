@@ -0,0 +1,116 @@
+"""
+Laudus JWT Token Cache
+Shared by the fetch scripts so consecutive runs can skip /security/login
+Backed by Redis when REDIS_URL is set, otherwise by a local file
+"""
+
+import os
+import json
+import time
+import base64
+from typing import Dict, Optional
+
+try:
+    import redis
+except ImportError:  # Optional: only needed when REDIS_URL is set
+    redis = None
+
+TOKEN_CACHE_FILE = os.path.expanduser('~/.cache/laudus/token.json')
+MIN_TTL = 60  # Seconds of validity required to reuse a cached token
+
+# Per-process memo so repeated lookups don't touch disk/Redis
+_memo: Dict[str, Dict] = {}
+
+
+def get_token_expiry(token: str) -> Optional[float]:
+    """Read the exp claim from a JWT payload (signature is not verified)"""
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+class TokenCache:
+    """Token cache for one Laudus account (API URL + user + company)"""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.redis_key = f"laudus:token:{key}"
+        self.redis = None
+
+        redis_url = os.getenv('REDIS_URL')
+        if redis_url and redis is not None:
+            self.redis = redis.Redis.from_url(redis_url, socket_timeout=5)
+
+    def load(self) -> Optional[str]:
+        """Return the cached token if it is still valid for at least MIN_TTL"""
+        cached = _memo.get(self.key) or self._read()
+        if not cached or cached.get('exp', 0) <= time.time() + MIN_TTL:
+            return None
+
+        _memo[self.key] = cached
+        return cached.get('token')
+
+    def save(self, token: str) -> bool:
+        """Store token with its expiry"""
+        exp = get_token_expiry(token)
+        if exp is None:
+            return False
+
+        cached = {'key': self.key, 'token': token, 'exp': exp}
+        _memo[self.key] = cached
+
+        if self.redis is not None:
+            try:
+                ttl = int(exp - time.time())
+                if ttl > 0:
+                    self.redis.setex(self.redis_key, ttl, json.dumps(cached))
+                return True
+            except redis.RedisError:
+                pass  # Fall back to the local file
+
+        try:
+            os.makedirs(os.path.dirname(TOKEN_CACHE_FILE), exist_ok=True)
+            fd = os.open(TOKEN_CACHE_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(cached, f)
+            return True
+        except OSError:
+            return False
+
+    def invalidate(self):
+        """Remove the cached token everywhere"""
+        _memo.pop(self.key, None)
+
+        if self.redis is not None:
+            try:
+                self.redis.delete(self.redis_key)
+            except redis.RedisError:
+                pass
+
+        try:
+            os.remove(TOKEN_CACHE_FILE)
+        except OSError:
+            pass
+
+    def _read(self) -> Optional[Dict]:
+        """Read the stored entry for this key from Redis or the local file"""
+        if self.redis is not None:
+            try:
+                raw = self.redis.get(self.redis_key)
+                if raw:
+                    return json.loads(raw)
+            except (redis.RedisError, ValueError):
+                pass
+
+        try:
+            with open(TOKEN_CACHE_FILE, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if not isinstance(cached, dict) or cached.get('key') != self.key:
+            return None
+        return cached
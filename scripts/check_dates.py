@@ -3,21 +3,45 @@
 Script para verificar las fechas disponibles en MongoDB
 """
 import os
-from pymongo import MongoClient
-from datetime import datetime
+import sys
+from datetime import date, datetime
 from collections import defaultdict
 
+from _mongo import get_client, close_client, is_valid_uri
+
 # Configuración
 MONGODB_URI = os.getenv('MONGODB_URI')
 MONGODB_DATABASE = 'laudus_data'
 
+# Columna de la tabla para cada colección revisada
+COLUMN_LABELS = {
+    'totals': 'Totals',
+    'standard': 'Standard',
+    '8columns': '8 Columns',
+}
+
+def find_missing_dates(sorted_dates):
+    """Fechas (YYYY-MM-DD) sin datos entre la primera y la última de sorted_dates"""
+    # Días esperados como rango de ordinales (sin bucle día a día)
+    start_ordinal = datetime.strptime(sorted_dates[0], '%Y-%m-%d').toordinal()
+    end_ordinal = datetime.strptime(sorted_dates[-1], '%Y-%m-%d').toordinal()
+    
+    expected_dates = {date.fromordinal(o).isoformat() for o in range(start_ordinal, end_ordinal + 1)}
+    
+    return sorted(expected_dates.difference(sorted_dates))
+
 def main():
-    # Conectar a MongoDB
-    client = MongoClient(MONGODB_URI)
+    if not is_valid_uri(MONGODB_URI):
+        print("❌ MONGODB_URI debe estar definida y comenzar con mongodb:// o mongodb+srv://")
+        sys.exit(1)
+    
+    # Conectar a MongoDB (cliente compartido, con compresión)
+    client = get_client(MONGODB_URI)
     db = client[MONGODB_DATABASE]
     
-    # Colecciones a revisar
+    # Colecciones a revisar (la tabla muestra solo estas)
     collections = ['balance_8columns']
+    keys = [name.replace('balance_', '') for name in collections]
     
     print("=" * 80)
     print("FECHAS DISPONIBLES EN MONGODB - LAUDUS DATA")
@@ -25,13 +49,13 @@ def main():
     print()
     
     # Diccionario para agrupar fechas
-    all_dates = defaultdict(lambda: {'8columns': False})
+    all_dates = defaultdict(lambda: dict.fromkeys(keys, False))
     
     # Revisar cada colección
     for collection_name in collections:
         collection = db[collection_name]
         
-        # Obtener todas las fechas únicas
+        # Obtener todas las fechas únicas (los fetchers crean el índice por fecha que usa distinct)
         dates = collection.distinct('date')
         dates.sort()
         
@@ -39,8 +63,8 @@ def main():
         key_name = collection_name.replace('balance_', '')
         
         # Marcar fechas disponibles
-        for date in dates:
-            all_dates[date][key_name] = True
+        for date_str in dates:
+            all_dates[date_str][key_name] = True
     
     # Ordenar fechas
     sorted_dates = sorted(all_dates.keys())
@@ -53,57 +77,51 @@ def main():
     print(f"Total de fechas únicas: {len(sorted_dates)}")
     print(f"Rango: {sorted_dates[0]} → {sorted_dates[-1]}")
     print()
-    print("┌────────────┬─────────┬──────────┬───────────┬────────┐")
-    print("│   Fecha    │ Totals  │ Standard │ 8 Columns │ Status │")
-    print("├────────────┼─────────┼──────────┼───────────┼────────┤")
-    
-    for date in sorted_dates:
-        totals = '✓' if all_dates[date]['totals'] else '✗'
-        standard = '✓' if all_dates[date]['standard'] else '✗'
-        columns8 = '✓' if all_dates[date]['8columns'] else '✗'
+    labels = [COLUMN_LABELS[key] for key in keys]
+    widths = [max(len(label), 7) + 2 for label in labels]
+    
+    print("┌────────────┬" + "".join("─" * w + "┬" for w in widths) + "────────┐")
+    print("│   Fecha    │" + "".join(label.center(w) + "│" for label, w in zip(labels, widths)) + " Status │")
+    print("├────────────┼" + "".join("─" * w + "┼" for w in widths) + "────────┤")
+    
+    # Acumular filas y escribir la tabla de una vez
+    rows = []
+    complete = 0
+    partial = 0
+    for date_str in sorted_dates:
+        flags = all_dates[date_str]
+        marks = "".join(('✓' if flags[key] else '✗').center(w) + "│" for key, w in zip(keys, widths))
         
-        # Status: Completo si tiene los 3, Parcial si tiene algunos, Vacío si no tiene ninguno
-        count = sum([all_dates[date]['totals'], all_dates[date]['standard'], all_dates[date]['8columns']])
-        if count == 3:
+        # Status: Completo si está en todas las colecciones revisadas, Parcial si en algunas
+        count = sum(flags.values())
+        if count == len(keys):
             status = '✅'
+            complete += 1
         elif count > 0:
             status = '⚠️ '
+            partial += 1
         else:
             status = '❌'
         
-        print(f"│ {date} │    {totals}    │    {standard}     │     {columns8}     │   {status}   │")
+        rows.append(f"│ {date_str} │{marks}   {status}   │")
     
-    print("└────────────┴─────────┴──────────┴───────────┴────────┘")
+    print("\n".join(rows))
+    print("└────────────┴" + "".join("─" * w + "┴" for w in widths) + "────────┘")
     print()
     
-    # Estadísticas
-    complete = sum(1 for date in all_dates.values() if all(date.values()))
-    partial = sum(1 for date in all_dates.values() if any(date.values()) and not all(date.values()))
-    
+    # Estadísticas (mismos flags que la tabla)
     print("RESUMEN:")
-    print(f"  ✅ Fechas completas (3/3 colecciones): {complete}")
-    print(f"  ⚠️  Fechas parciales (1-2 colecciones): {partial}")
+    print(f"  ✅ Fechas completas ({len(keys)}/{len(keys)} colecciones): {complete}")
+    print(f"  ⚠️  Fechas parciales: {partial}")
     print(f"  📊 Total de fechas: {len(sorted_dates)}")
     print()
     
     # Detectar gaps (fechas faltantes)
     if len(sorted_dates) >= 2:
-        from datetime import datetime, timedelta
-        
-        start_date = datetime.strptime(sorted_dates[0], '%Y-%m-%d')
-        end_date = datetime.strptime(sorted_dates[-1], '%Y-%m-%d')
-        
-        expected_dates = []
-        current = start_date
-        while current <= end_date:
-            expected_dates.append(current.strftime('%Y-%m-%d'))
-            current += timedelta(days=1)
-        
-        missing_dates = set(expected_dates) - set(sorted_dates)
+        missing_sorted = find_missing_dates(sorted_dates)
         
-        if missing_dates:
-            missing_sorted = sorted(missing_dates)
-            print(f"⚠️  GAPS DETECTADOS: {len(missing_dates)} fechas faltantes")
+        if missing_sorted:
+            print(f"⚠️  GAPS DETECTADOS: {len(missing_sorted)} fechas faltantes")
             print(f"   Primera faltante: {missing_sorted[0]}")
             print(f"   Última faltante: {missing_sorted[-1]}")
         else:
@@ -112,7 +130,7 @@ def main():
     print()
     print("=" * 80)
     
-    client.close()
+    close_client()
 
 if __name__ == '__main__':
     main()
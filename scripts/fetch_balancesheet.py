@@ -7,27 +7,44 @@ Migrated from PowerShell automation to Python for GitHub Actions
 import os
 import sys
 import json
+import atexit
+import queue
 import logging
-from datetime import datetime, timedelta
+from logging.handlers import QueueHandler, QueueListener
+from datetime import datetime, timedelta, timezone
 from typing import Dict, List, Optional
 import time
 
+import orjson
 import requests
-from pymongo import MongoClient
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from pymongo.errors import PyMongoError
 
+from _mongo import get_client, close_client, is_valid_uri
+
 # Configure logging
 LOG_DIR = os.path.join(os.path.dirname(__file__), 'logs')
 os.makedirs(LOG_DIR, exist_ok=True)
 
 log_file = os.path.join(LOG_DIR, f"{datetime.now().strftime('%Y-%m-%d')}-fetch.log")
+
+# File/stdout writes happen on a background listener thread
+log_queue = queue.Queue(-1)
+log_formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(message)s')
+file_handler = logging.FileHandler(log_file)
+file_handler.setFormatter(log_formatter)
+stream_handler = logging.StreamHandler(sys.stdout)
+stream_handler.setFormatter(log_formatter)
+log_listener = QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+# Records are pre-rendered as the bare message; the listener's handlers add the prefix
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s [%(levelname)s] %(message)s',
-    handlers=[
-        logging.FileHandler(log_file),
-        logging.StreamHandler(sys.stdout)
-    ]
+    format='%(message)s',
+    handlers=[QueueHandler(log_queue)]
 )
 logger = logging.getLogger(__name__)
 
@@ -61,6 +78,19 @@ class LaudusAPIClient:
         self.base_url = CONFIG['api_url']
         self.token: Optional[str] = None
         self.session = requests.Session()
+        
+        # Configure retry strategy (same as the manual fetcher)
+        retry_strategy = Retry(
+            total=2,  # Application-level retries handle longer outages
+            read=False,  # A read timeout (>900s) goes back to the main loop, not re-sent here
+            backoff_factor=10,  # Wait 10, 20 seconds
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["HEAD", "GET", "POST", "PUT", "DELETE", "OPTIONS", "TRACE"]
+        )
+        adapter = HTTPAdapter(max_retries=retry_strategy)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        
         self.session.headers.update({
             'Content-Type': 'application/json',
             'Accept': 'application/json'
@@ -84,20 +114,26 @@ class LaudusAPIClient:
             )
             response.raise_for_status()
             
-            # Extract token properly - response could be JSON or plain text
-            try:
-                # Try JSON first
-                token_data = response.json()
+            # Token comes back either as JSON (object or string) or as plain text
+            content_type = response.headers.get('Content-Type', '')
+            if 'application/json' in content_type:
+                try:
+                    token_data = orjson.loads(response.content)
+                except orjson.JSONDecodeError as e:
+                    raise ValueError(f"Invalid JSON login response: {e}") from e
+                
                 if isinstance(token_data, dict) and 'token' in token_data:
                     self.token = token_data['token']
                 elif isinstance(token_data, str):
                     self.token = token_data
                 else:
-                    self.token = str(token_data)
-            except:
-                # Fallback to text response
+                    raise ValueError(f"Unexpected token format: {type(token_data).__name__}")
+            else:
                 self.token = response.text.strip().strip('"').strip("'")
             
+            if not self.token:
+                raise ValueError("Login response has no token")
+            
             # Update session headers with token
             self.session.headers.update({
                 'Authorization': f'Bearer {self.token}',
@@ -106,7 +142,7 @@ class LaudusAPIClient:
             })
             
             logger.info("✅ Authentication successful")
-            logger.debug(f"Token length: {len(self.token)} chars")
+            logger.debug("Token length: %d chars", len(self.token))
             return True
             
         except Exception as e:
@@ -119,7 +155,7 @@ class LaudusAPIClient:
     def fetch_balance_sheet(self, endpoint: Dict, date_to: str) -> Optional[List[Dict]]:
         """Fetch balance sheet data from specified endpoint"""
         try:
-            logger.info(f"📊 Fetching {endpoint['name']}...")
+            logger.info("📊 Fetching %s...", endpoint['name'])
             
             params = {
                 'dateTo': date_to,
@@ -128,9 +164,9 @@ class LaudusAPIClient:
             }
             
             url = f"{self.base_url}{endpoint['path']}"
-            logger.info(f"   URL: {url}")
-            logger.debug(f"   Params: {params}")
-            logger.debug(f"   Has token: {self.token is not None}")
+            logger.info("   URL: %s", url)
+            logger.debug("   Params: %s", params)
+            logger.debug("   Has token: %s", self.token is not None)
             
             response = self.session.get(
                 url,
@@ -139,10 +175,11 @@ class LaudusAPIClient:
             )
             response.raise_for_status()
             
-            data = response.json()
+            # orjson parses the raw bytes directly (large 8-column payloads)
+            data = orjson.loads(response.content)
             record_count = len(data)
             
-            logger.info(f"✅ {endpoint['name']}: {record_count} records retrieved")
+            logger.info("✅ %s: %d records retrieved", endpoint['name'], record_count)
             return data
             
         except requests.Timeout:
@@ -166,17 +203,24 @@ class MongoDBClient:
         self.client = None
         self.db = None
         self.connected = False
+        # One timestamp per run so every endpoint saved together shares insertedAt
+        self.run_at = datetime.now(timezone.utc)
     
     def connect(self) -> bool:
         """Connect to MongoDB Atlas"""
         try:
             logger.info("🔌 Connecting to MongoDB Atlas...")
             
-            self.client = MongoClient(CONFIG['mongodb_uri'])
+            # Shared per-process client (pinged once on first use)
+            self.client = get_client(CONFIG['mongodb_uri'])
             self.db = self.client[CONFIG['mongodb_database']]
             
-            # Test connection
-            self.client.admin.command('ping')
+            # Index by date so check_dates' distinct walks the index instead of every document
+            for endpoint in ENDPOINTS:
+                try:
+                    self.db[endpoint['collection']].create_index([('date', 1)])
+                except PyMongoError as e:
+                    logger.warning(f"⚠️ Could not create date index on {endpoint['collection']}: {e}")
             
             self.connected = True
             logger.info("✅ MongoDB connection successful")
@@ -199,7 +243,7 @@ class MongoDBClient:
                 'date': date_str,
                 'endpointType': endpoint_name,
                 'recordCount': len(data),
-                'insertedAt': datetime.utcnow(),
+                'insertedAt': self.run_at,
                 'loadSource': 'automatic',
                 'data': data
             }
@@ -225,7 +269,8 @@ class MongoDBClient:
     def close(self):
         """Close MongoDB connection"""
         if self.client:
-            self.client.close()
+            close_client()
+            self.client = None
             logger.info("🔌 MongoDB connection closed")
 
 
@@ -249,6 +294,10 @@ def main():
         logger.error("Required: LAUDUS_PASSWORD, LAUDUS_COMPANY_VAT, MONGODB_URI")
         sys.exit(1)
     
+    if not is_valid_uri(CONFIG['mongodb_uri']):
+        logger.error("❌ MONGODB_URI must start with mongodb:// or mongodb+srv://")
+        sys.exit(1)
+    
     # Initialize clients
     api_client = LaudusAPIClient()
     mongo_client = MongoDBClient()
@@ -13,12 +13,14 @@ from datetime import datetime, timezone
 from typing import Dict, List, Optional
 import argparse
 
+import orjson
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
-from pymongo import MongoClient
 from pymongo.errors import PyMongoError
 
+from _mongo import get_client, close_client, is_valid_uri
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -91,20 +93,26 @@ class LaudusAPIClient:
             )
             response.raise_for_status()
             
-            # Extract token properly - response could be JSON or plain text
-            try:
-                # Try JSON first
-                token_data = response.json()
+            # Token comes back either as JSON (object or string) or as plain text
+            content_type = response.headers.get('Content-Type', '')
+            if 'application/json' in content_type:
+                try:
+                    token_data = orjson.loads(response.content)
+                except orjson.JSONDecodeError as e:
+                    raise ValueError(f"Respuesta de login JSON invalida: {e}") from e
+                
                 if isinstance(token_data, dict) and 'token' in token_data:
                     self.token = token_data['token']
                 elif isinstance(token_data, str):
                     self.token = token_data
                 else:
-                    self.token = str(token_data)
-            except:
-                # Fallback to text response
+                    raise ValueError(f"Formato de token inesperado: {type(token_data).__name__}")
+            else:
                 self.token = response.text.strip().strip('"').strip("'")
             
+            if not self.token:
+                raise ValueError("Respuesta de login sin token")
+            
             # Update session headers with token
             self.session.headers.update({
                 'Authorization': f'Bearer {self.token}',
@@ -113,7 +121,7 @@ class LaudusAPIClient:
             })
             
             logger.info("Autenticacion exitosa")
-            logger.debug(f"Token length: {len(self.token)} chars")
+            logger.debug("Token length: %d chars", len(self.token))
             return True
             
         except Exception as e:
@@ -133,9 +141,9 @@ class LaudusAPIClient:
             }
             
             url = f"{self.base_url}{endpoint['path']}"
-            logger.debug(f"URL: {url}")
-            logger.debug(f"Params: {params}")
-            logger.debug(f"Has token: {self.token is not None}")
+            logger.debug("URL: %s", url)
+            logger.debug("Params: %s", params)
+            logger.debug("Has token: %s", self.token is not None)
             
             response = self.session.get(
                 url,
@@ -144,10 +152,11 @@ class LaudusAPIClient:
             )
             response.raise_for_status()
             
-            data = response.json()
+            # orjson parses the raw bytes directly (large 8-column payloads)
+            data = orjson.loads(response.content)
             record_count = len(data)
             
-            logger.info(f"{endpoint['name']}: {record_count} registros obtenidos")
+            logger.info("%s: %d registros obtenidos", endpoint['name'], record_count)
             return data
             
         except requests.Timeout:
@@ -177,11 +186,15 @@ class MongoDBClient:
         try:
             logger.info("Conectando a MongoDB Atlas...")
             
-            self.client = MongoClient(CONFIG['mongodb_uri'])
+            # Shared per-process client (pinged once on first use)
+            self.client = get_client(CONFIG['mongodb_uri'])
             self.db = self.client[CONFIG['mongodb_database']]
             
-            # Test connection
-            self.client.admin.command('ping')
+            # Indice por fecha para que el distinct de check_dates recorra el indice
+            try:
+                self.db[ENDPOINT['collection']].create_index([('date', 1)])
+            except PyMongoError as e:
+                logger.warning(f"No se pudo crear el indice por fecha: {e}")
             
             self.connected = True
             logger.info("Conexion a MongoDB exitosa")
@@ -226,7 +239,8 @@ class MongoDBClient:
     def close(self):
         """Close MongoDB connection"""
         if self.client:
-            self.client.close()
+            close_client()
+            self.client = None
             logger.info("Conexion a MongoDB cerrada")
 
 
@@ -253,6 +267,10 @@ def main():
         logger.error("Requeridas: LAUDUS_PASSWORD, LAUDUS_COMPANY_VAT, MONGODB_URI")
         sys.exit(1)
     
+    if not is_valid_uri(CONFIG['mongodb_uri']):
+        logger.error("MONGODB_URI debe comenzar con mongodb:// o mongodb+srv://")
+        sys.exit(1)
+    
     # Initialize clients
     api_client = LaudusAPIClient()
     mongo_client = MongoDBClient()
@@ -2,6 +2,7 @@
 """
 Laudus Invoices By Branch Fetcher
 For manual data loading with specific year and month
+Set BRANCH_START_DATE (and optionally BRANCH_END_DATE) to fetch a custom range
 Endpoint: /reports/sales/invoices/byBranch
 """
 
@@ -10,17 +11,21 @@ import sys
 import json
 import logging
 import time
+import random
 import calendar
 from datetime import datetime, timezone
 from typing import Dict, List, Optional
 import argparse
 
+import orjson
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
-from pymongo import MongoClient
 from pymongo.errors import PyMongoError
 
+from _mongo import get_client, close_client, is_valid_uri
+from _token_cache import TokenCache
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -37,8 +42,11 @@ CONFIG = {
     'company_vat': os.getenv('LAUDUS_COMPANY_VAT'),
     'mongodb_uri': os.getenv('MONGODB_URI'),
     'mongodb_database': os.getenv('MONGODB_DATABASE', 'laudus_data'),
+    'range_start': os.getenv('BRANCH_START_DATE'),  # Optional single-range mode (YYYY-MM-DD)
+    'range_end': os.getenv('BRANCH_END_DATE'),
     'timeout': 300,  # 5 minutes
-    'retry_delay': 60,  # 1 minute between retries
+    'retry_base_delay': 5,  # Exponential backoff base (5, 10, 20... seconds)
+    'retry_max_delay': 300,  # Backoff cap (5 minutes)
     'max_retries': 10,  # Maximum retry attempts
 }
 
@@ -50,12 +58,19 @@ ENDPOINT = {
 }
 
 
+def get_retry_delay(attempt: int) -> float:
+    """Exponential backoff with jitter for application-level retries"""
+    base = CONFIG['retry_base_delay']
+    return min(CONFIG['retry_max_delay'], base * 2 ** (attempt - 1)) + random.uniform(0, base)
+
+
 class LaudusAPIClient:
     """Client for Laudus API interactions"""
     
     def __init__(self):
         self.base_url = CONFIG['api_url']
         self.token: Optional[str] = None
+        self.token_cache = TokenCache(self._cache_key())
         self.session = requests.Session()
         
         # Configure retry strategy
@@ -74,8 +89,34 @@ class LaudusAPIClient:
             'Accept': 'application/json'
         })
     
-    def authenticate(self) -> bool:
-        """Get JWT token from Laudus API"""
+    def _cache_key(self) -> str:
+        """Identify the account a cached token belongs to"""
+        return f"{self.base_url}|{CONFIG['username']}|{CONFIG['company_vat']}"
+    
+    def invalidate_token(self):
+        """Drop the current token and its cached copy"""
+        self.token = None
+        self.session.headers.pop('Authorization', None)
+        self.token_cache.invalidate()
+    
+    def _apply_token(self):
+        """Attach the current token to the session headers"""
+        self.session.headers.update({
+            'Authorization': f'Bearer {self.token}',
+            'Content-Type': 'application/json',
+            'Accept': 'application/json'
+        })
+    
+    def authenticate(self, force: bool = False) -> bool:
+        """Get JWT token from Laudus API, reusing a cached one unless forced"""
+        if not force:
+            cached_token = self.token_cache.load()
+            if cached_token:
+                self.token = cached_token
+                self._apply_token()
+                logger.info("Autenticacion reutilizada desde cache")
+                return True
+        
         try:
             logger.info(f"Autenticando con Laudus {CONFIG['api_url']}...")
             
@@ -87,27 +128,33 @@ class LaudusAPIClient:
             
             response = self.session.post(
                 f"{self.base_url}/security/login",
-                json=payload,
+                data=orjson.dumps(payload),
                 timeout=30
             )
             response.raise_for_status()
             
-            try:
-                token_data = response.json()
+            # Token comes back either as JSON (object or string) or as plain text
+            content_type = response.headers.get('Content-Type', '')
+            if 'application/json' in content_type:
+                try:
+                    token_data = orjson.loads(response.content)
+                except orjson.JSONDecodeError as e:
+                    raise ValueError(f"Respuesta de login JSON invalida: {e}") from e
+                
                 if isinstance(token_data, dict) and 'token' in token_data:
                     self.token = token_data['token']
                 elif isinstance(token_data, str):
                     self.token = token_data
                 else:
-                    self.token = str(token_data)
-            except:
+                    raise ValueError(f"Formato de token inesperado: {type(token_data).__name__}")
+            else:
                 self.token = response.text.strip().strip('"').strip("'")
             
-            self.session.headers.update({
-                'Authorization': f'Bearer {self.token}',
-                'Content-Type': 'application/json',
-                'Accept': 'application/json'
-            })
+            if not self.token:
+                raise ValueError("Respuesta de login sin token")
+            
+            self._apply_token()
+            self.token_cache.save(self.token)
             
             logger.info("Autenticacion exitosa")
             return True
@@ -128,20 +175,32 @@ class LaudusAPIClient:
             }
             
             url = f"{self.base_url}{ENDPOINT['path']}"
-            logger.debug(f"URL: {url}")
-            logger.debug(f"Params: {params}")
+            logger.debug("URL: %s", url)
+            logger.debug("Params: %s", params)
             
             response = self.session.get(
                 url,
                 params=params,
                 timeout=CONFIG['timeout']
             )
+            
+            # Cached token may have been revoked: re-authenticate once
+            if response.status_code == 401:
+                logger.info("Token rechazado (401), reautenticando...")
+                self.invalidate_token()
+                if not self.authenticate(force=True):
+                    return None
+                response = self.session.get(
+                    url,
+                    params=params,
+                    timeout=CONFIG['timeout']
+                )
             response.raise_for_status()
             
-            data = response.json()
+            data = orjson.loads(response.content)
             record_count = len(data) if isinstance(data, list) else 1
             
-            logger.info(f"{ENDPOINT['name']}: {record_count} registros obtenidos")
+            logger.info("%s: %d registros obtenidos", ENDPOINT['name'], record_count)
             return data if isinstance(data, list) else [data]
             
         except requests.Timeout:
@@ -164,6 +223,29 @@ MONTH_NAMES = {
     9: 'Septiembre', 10: 'Octubre', 11: 'Noviembre', 12: 'Diciembre'
 }
 
+# Monthly totals computed by MongoDB from the branches array
+# Exposed as a read-only view so consumers don't depend on stored aggregates
+TOTALS_VIEW = 'invoices_by_branch_totals'
+BRANCH_TOTALS_PIPELINE = [
+    {'$unwind': '$branches'},
+    {'$group': {
+        '_id': '$month',
+        'year': {'$first': '$year'},
+        'monthNumber': {'$first': '$monthNumber'},
+        'monthName': {'$first': '$monthName'},
+        'branchCount': {'$sum': 1},
+        'totalNet': {'$sum': '$branches.net'},
+        'totalMargin': {'$sum': '$branches.margin'},
+        'totalDiscounts': {'$sum': '$branches.discounts'},
+        'avgMarginPercentage': {'$avg': '$branches.marginPercentage'},
+        'avgDiscountPercentage': {'$avg': '$branches.discountsPercentage'}
+    }},
+    {'$sort': {'_id': 1}}
+]
+
+# Arbitrary BRANCH_START_DATE..BRANCH_END_DATE loads, kept apart from the monthly documents
+RANGE_COLLECTION = 'invoices_by_branch_ranges'
+
 
 class MongoDBClient:
     """Client for MongoDB Atlas interactions"""
@@ -178,10 +260,15 @@ class MongoDBClient:
         try:
             logger.info("Conectando a MongoDB Atlas...")
             
-            self.client = MongoClient(CONFIG['mongodb_uri'])
+            # Shared per-process client (pinged once on first use)
+            self.client = get_client(CONFIG['mongodb_uri'])
             self.db = self.client[CONFIG['mongodb_database']]
             
-            self.client.admin.command('ping')
+            # Unique index so upserts by month use a B-tree lookup and never duplicate
+            try:
+                self.db[ENDPOINT['collection']].create_index('month', unique=True)
+            except PyMongoError as e:
+                logger.warning(f"No se pudo crear el indice por mes: {e}")
             
             self.connected = True
             logger.info("Conexion a MongoDB exitosa")
@@ -191,6 +278,53 @@ class MongoDBClient:
             logger.error(f"Error de conexion a MongoDB: {e}")
             return False
     
+    @staticmethod
+    def _build_branches(data: List[Dict]) -> List[Dict]:
+        """Build the branches array from the API payload"""
+        return [
+            {
+                'branch': branch_data.get('branchName') or branch_data.get('branch', 'Sin Sucursal'),
+                'net': branch_data.get('net', 0),
+                'netPercentage': branch_data.get('netPercentage', 0),
+                'margin': branch_data.get('margin', 0),
+                'marginPercentage': branch_data.get('marginPercentage', 0),
+                'discounts': branch_data.get('discounts', 0),
+                'discountsPercentage': branch_data.get('discountsPercentage', 0)
+            }
+            for branch_data in data
+        ]
+    
+    def save_range_data(self, data: List[Dict], first_day: str, last_day: str) -> bool:
+        """Save a single-range load to RANGE_COLLECTION, one document per start/end pair"""
+        try:
+            if not self.connected:
+                raise Exception("No conectado a MongoDB")
+            
+            if not data or len(data) == 0:
+                logger.warning("No hay datos para guardar")
+                return False
+            
+            branches = self._build_branches(data)
+            
+            # Keyed by the range itself so it never replaces a monthly document
+            document = {
+                '_id': f"{first_day}_{last_day}",
+                'startDate': first_day,
+                'endDate': last_day,
+                'branchCount': len(branches),
+                'branches': branches,
+                'insertedAt': datetime.now(timezone.utc)
+            }
+            
+            self.db[RANGE_COLLECTION].replace_one({'_id': document['_id']}, document, upsert=True)
+            
+            logger.info(f"Guardado en MongoDB: {RANGE_COLLECTION} ({len(branches)} sucursales para {first_day} a {last_day})")
+            return True
+                
+        except PyMongoError as e:
+            logger.error(f"Error guardando en MongoDB: {e}")
+            return False
+    
     def save_data(self, collection_name: str, data: List[Dict], period: str, year: int, month: int, first_day: str, last_day: str) -> bool:
         """Save invoices by branch data to MongoDB - one document per month with branches array"""
         try:
@@ -203,42 +337,13 @@ class MongoDBClient:
                 logger.warning("No hay datos para guardar")
                 return False
             
-            # Build branches array from data
-            branches = []
-            total_net = 0
-            total_margin = 0
-            total_discounts = 0
-            
-            for branch_data in data:
-                branch_name = branch_data.get('branchName') or branch_data.get('branch', 'Sin Sucursal')
-                net = branch_data.get('net', 0)
-                margin = branch_data.get('margin', 0)
-                discounts = branch_data.get('discounts', 0)
-                
-                total_net += net
-                total_margin += margin
-                total_discounts += discounts
-                
-                branches.append({
-                    'branch': branch_name,
-                    'net': net,
-                    'netPercentage': branch_data.get('netPercentage', 0),
-                    'margin': margin,
-                    'marginPercentage': branch_data.get('marginPercentage', 0),
-                    'discounts': discounts,
-                    'discountsPercentage': branch_data.get('discountsPercentage', 0)
-                })
-            
-            # Calculate averages
+            # Monthly totals/averages are derived server-side (see BRANCH_TOTALS_PIPELINE)
+            branches = self._build_branches(data)
             branch_count = len(branches)
-            avg_discount_percentage = sum(b.get('discountsPercentage', 0) for b in branches) / branch_count if branch_count > 0 else 0
-            avg_margin_percentage = sum(b.get('marginPercentage', 0) for b in branches) / branch_count if branch_count > 0 else 0
             
             # Build document in expected format
             document = {
                 'month': period,  # YYYY-MM format
-                'avgDiscountPercentage': avg_discount_percentage,
-                'avgMarginPercentage': avg_margin_percentage,
                 'branchCount': branch_count,
                 'branches': branches,
                 'endDate': last_day,
@@ -246,9 +351,6 @@ class MongoDBClient:
                 'monthName': MONTH_NAMES.get(month, ''),
                 'monthNumber': month,
                 'startDate': first_day,
-                'totalDiscounts': total_discounts,
-                'totalMargin': total_margin,
-                'totalNet': total_net,
                 'year': year
             }
             
@@ -260,13 +362,33 @@ class MongoDBClient:
             )
             
             logger.info(f"Guardado en MongoDB: {collection_name} ({branch_count} sucursales para {period})")
-            logger.info(f"   Total Net: {total_net:,.0f} | Total Margin: {total_margin:,.2f}")
             return True
                 
         except PyMongoError as e:
             logger.error(f"Error guardando en MongoDB: {e}")
             return False
     
+    def ensure_totals_view(self) -> bool:
+        """Create the monthly totals view, or sync an existing one with BRANCH_TOTALS_PIPELINE"""
+        try:
+            if not self.connected:
+                return False
+            
+            # collMod keeps deployed views in step with later edits to the pipeline
+            exists = bool(self.db.list_collection_names(filter={'name': TOTALS_VIEW}))
+            self.db.command(
+                'collMod' if exists else 'create',
+                TOTALS_VIEW,
+                viewOn=ENDPOINT['collection'],
+                pipeline=BRANCH_TOTALS_PIPELINE
+            )
+            logger.info(f"Vista de totales {'actualizada' if exists else 'creada'}: {TOTALS_VIEW}")
+            return True
+            
+        except PyMongoError as e:
+            logger.warning(f"No se pudo crear o actualizar la vista de totales: {e}")
+            return False
+    
     def update_job_status(self, job_id: str, status: str, error: str = None, records: int = 0) -> bool:
         """Update job status in load_data_status collection"""
         try:
@@ -278,7 +400,7 @@ class MongoDBClient:
             
             update_data = {
                 'status': status,
-                'completedAt': datetime.now(timezone.utc).isoformat()
+                'completedAt': datetime.now(timezone.utc)
             }
             
             if error:
@@ -310,7 +432,8 @@ class MongoDBClient:
     def close(self):
         """Close MongoDB connection"""
         if self.client:
-            self.client.close()
+            close_client()
+            self.client = None
             logger.info("Conexion a MongoDB cerrada")
 
 
@@ -338,10 +461,33 @@ def main():
     last_day = f"{year}-{month:02d}-{last_day_num:02d}"
     period = f"{year}-{month:02d}"
     
+    # Single-range mode: override the month boundaries with the configured range
+    # Results go to RANGE_COLLECTION, never to the monthly document for --year/--month
+    mode = 'monthly'
+    if CONFIG['range_end'] and not CONFIG['range_start']:
+        logger.error("BRANCH_END_DATE requiere BRANCH_START_DATE")
+        sys.exit(1)
+    if CONFIG['range_start']:
+        mode = 'range'
+        try:
+            range_start = datetime.strptime(CONFIG['range_start'], '%Y-%m-%d')
+            range_end = datetime.strptime(CONFIG['range_end'] or last_day, '%Y-%m-%d')
+        except ValueError:
+            logger.error("BRANCH_START_DATE/BRANCH_END_DATE deben tener formato YYYY-MM-DD")
+            sys.exit(1)
+        if range_start > range_end:
+            logger.error("BRANCH_START_DATE debe ser anterior a BRANCH_END_DATE")
+            sys.exit(1)
+        # strptime accepts 2025-1-5: normalise so the range _id is always zero-padded
+        first_day = range_start.strftime('%Y-%m-%d')
+        last_day = range_end.strftime('%Y-%m-%d')
+        period = f"{first_day}_{last_day}"
+    
     logger.info("=" * 60)
     logger.info("  CARGA FACTURAS POR SUCURSAL")
     logger.info("=" * 60)
     logger.info(f"Periodo: {period}")
+    logger.info(f"Modo: {mode}")
     logger.info(f"Rango: {first_day} a {last_day}")
     logger.info(f"Endpoint: {ENDPOINT['name']}")
     logger.info("")
@@ -352,6 +498,10 @@ def main():
         logger.error("Requeridas: LAUDUS_PASSWORD, LAUDUS_COMPANY_VAT, MONGODB_URI")
         sys.exit(1)
     
+    if not is_valid_uri(CONFIG['mongodb_uri']):
+        logger.error("MONGODB_URI debe comenzar con mongodb:// o mongodb+srv://")
+        sys.exit(1)
+    
     # Initialize clients
     api_client = LaudusAPIClient()
     mongo_client = MongoDBClient()
@@ -366,40 +516,53 @@ def main():
         logger.error("Error al conectar con MongoDB")
         sys.exit(1)
     
+    mongo_client.ensure_totals_view()
+    
     # Track completion status
     completed = False
     result = {'endpoint': ENDPOINT['name'], 'success': False, 'records': 0}
     attempt = 0
     max_attempts = CONFIG['max_retries']
+    data = None
     
     # Main retry loop
     while attempt < max_attempts and not completed:
         attempt += 1
         logger.info(f"--- Intento #{attempt} ---")
         
-        # Renew token every 3 attempts
-        if attempt > 1 and attempt % 3 == 1:
+        # Renew token every 3 attempts (not needed when only the MongoDB save is retried)
+        if data is None and attempt > 1 and attempt % 3 == 1:
             logger.info("Renovando token de autenticacion...")
-            if not api_client.authenticate():
+            if not api_client.authenticate(force=True):
                 logger.error("Error al renovar token")
-                time.sleep(CONFIG['retry_delay'])
+                time.sleep(get_retry_delay(attempt))
                 continue
         
-        # Fetch data
-        logger.info(f"Obteniendo {ENDPOINT['name']}...")
-        data = api_client.fetch_invoices_by_branch(first_day, last_day)
+        # Fetch data (HTTP 429/5xx are already retried by the session adapter)
+        # If only the MongoDB save failed, reuse the payload from the previous attempt
+        if data is None:
+            logger.info(f"Obteniendo {ENDPOINT['name']}...")
+            data = api_client.fetch_invoices_by_branch(first_day, last_day)
+            
+            # An empty payload counts as a failed fetch: wait and fetch again
+            if data is not None and not data:
+                logger.warning(f"{ENDPOINT['name']} devolvio datos vacios")
+                data = None
         
         if data is not None:
             # Save to MongoDB
-            success = mongo_client.save_data(
-                ENDPOINT['collection'],
-                data,
-                period,
-                year,
-                month,
-                first_day,
-                last_day
-            )
+            if mode == 'range':
+                success = mongo_client.save_range_data(data, first_day, last_day)
+            else:
+                success = mongo_client.save_data(
+                    ENDPOINT['collection'],
+                    data,
+                    period,
+                    year,
+                    month,
+                    first_day,
+                    last_day
+                )
             
             if success:
                 completed = True
@@ -408,14 +571,16 @@ def main():
                 logger.info(f"[OK] {ENDPOINT['name']} completado exitosamente")
                 break
             else:
+                # Empty payloads never reach save_data, so this is a MongoDB error: keep data
                 logger.error(f"[FAIL] Error al guardar en MongoDB")
         else:
             logger.error(f"[FAIL] Error al obtener {ENDPOINT['name']}")
         
-        # Wait before next attempt
+        # Wait before next attempt (a failed MongoDB save is retried with the same data)
         if attempt < max_attempts and not completed:
-            logger.info(f"Esperando {CONFIG['retry_delay']}s antes de reintentar...")
-            time.sleep(CONFIG['retry_delay'])
+            delay = get_retry_delay(attempt)
+            logger.info(f"Esperando {delay:.0f}s antes de reintentar...")
+            time.sleep(delay)
     
     # Final summary
     logger.info("")
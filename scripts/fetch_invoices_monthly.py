@@ -10,17 +10,21 @@ import sys
 import json
 import logging
 import time
+import random
 import calendar
 from datetime import datetime, timezone
 from typing import Dict, List, Optional
 import argparse
 
+import orjson
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
-from pymongo import MongoClient
 from pymongo.errors import PyMongoError
 
+from _mongo import get_client, close_client, is_valid_uri
+from _token_cache import TokenCache
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -38,7 +42,8 @@ CONFIG = {
     'mongodb_uri': os.getenv('MONGODB_URI'),
     'mongodb_database': os.getenv('MONGODB_DATABASE', 'laudus_data'),
     'timeout': 300,  # 5 minutes
-    'retry_delay': 60,  # 1 minute between retries
+    'retry_base_delay': 5,  # Exponential backoff base (5, 10, 20... seconds)
+    'retry_max_delay': 300,  # Backoff cap (5 minutes)
     'max_retries': 10,  # Maximum retry attempts
 }
 
@@ -50,12 +55,19 @@ ENDPOINT = {
 }
 
 
+def get_retry_delay(attempt: int) -> float:
+    """Exponential backoff with jitter for application-level retries"""
+    base = CONFIG['retry_base_delay']
+    return min(CONFIG['retry_max_delay'], base * 2 ** (attempt - 1)) + random.uniform(0, base)
+
+
 class LaudusAPIClient:
     """Client for Laudus API interactions"""
     
     def __init__(self):
         self.base_url = CONFIG['api_url']
         self.token: Optional[str] = None
+        self.token_cache = TokenCache(self._cache_key())
         self.session = requests.Session()
         
         # Configure retry strategy
@@ -74,8 +86,34 @@ class LaudusAPIClient:
             'Accept': 'application/json'
         })
     
-    def authenticate(self) -> bool:
-        """Get JWT token from Laudus API"""
+    def _cache_key(self) -> str:
+        """Identify the account a cached token belongs to"""
+        return f"{self.base_url}|{CONFIG['username']}|{CONFIG['company_vat']}"
+    
+    def invalidate_token(self):
+        """Drop the current token and its cached copy"""
+        self.token = None
+        self.session.headers.pop('Authorization', None)
+        self.token_cache.invalidate()
+    
+    def _apply_token(self):
+        """Attach the current token to the session headers"""
+        self.session.headers.update({
+            'Authorization': f'Bearer {self.token}',
+            'Content-Type': 'application/json',
+            'Accept': 'application/json'
+        })
+    
+    def authenticate(self, force: bool = False) -> bool:
+        """Get JWT token from Laudus API, reusing a cached one unless forced"""
+        if not force:
+            cached_token = self.token_cache.load()
+            if cached_token:
+                self.token = cached_token
+                self._apply_token()
+                logger.info("Autenticacion reutilizada desde cache")
+                return True
+        
         try:
             logger.info(f"Autenticando con Laudus {CONFIG['api_url']}...")
             
@@ -87,27 +125,33 @@ class LaudusAPIClient:
             
             response = self.session.post(
                 f"{self.base_url}/security/login",
-                json=payload,
+                data=orjson.dumps(payload),
                 timeout=30
             )
             response.raise_for_status()
             
-            try:
-                token_data = response.json()
+            # Token comes back either as JSON (object or string) or as plain text
+            content_type = response.headers.get('Content-Type', '')
+            if 'application/json' in content_type:
+                try:
+                    token_data = orjson.loads(response.content)
+                except orjson.JSONDecodeError as e:
+                    raise ValueError(f"Respuesta de login JSON invalida: {e}") from e
+                
                 if isinstance(token_data, dict) and 'token' in token_data:
                     self.token = token_data['token']
                 elif isinstance(token_data, str):
                     self.token = token_data
                 else:
-                    self.token = str(token_data)
-            except:
+                    raise ValueError(f"Formato de token inesperado: {type(token_data).__name__}")
+            else:
                 self.token = response.text.strip().strip('"').strip("'")
             
-            self.session.headers.update({
-                'Authorization': f'Bearer {self.token}',
-                'Content-Type': 'application/json',
-                'Accept': 'application/json'
-            })
+            if not self.token:
+                raise ValueError("Respuesta de login sin token")
+            
+            self._apply_token()
+            self.token_cache.save(self.token)
             
             logger.info("Autenticacion exitosa")
             return True
@@ -128,20 +172,32 @@ class LaudusAPIClient:
             }
             
             url = f"{self.base_url}{ENDPOINT['path']}"
-            logger.debug(f"URL: {url}")
-            logger.debug(f"Params: {params}")
+            logger.debug("URL: %s", url)
+            logger.debug("Params: %s", params)
             
             response = self.session.get(
                 url,
                 params=params,
                 timeout=CONFIG['timeout']
             )
+            
+            # Cached token may have been revoked: re-authenticate once
+            if response.status_code == 401:
+                logger.info("Token rechazado (401), reautenticando...")
+                self.invalidate_token()
+                if not self.authenticate(force=True):
+                    return None
+                response = self.session.get(
+                    url,
+                    params=params,
+                    timeout=CONFIG['timeout']
+                )
             response.raise_for_status()
             
-            data = response.json()
+            data = orjson.loads(response.content)
             record_count = len(data) if isinstance(data, list) else 1
             
-            logger.info(f"{ENDPOINT['name']}: {record_count} registros obtenidos")
+            logger.info("%s: %d registros obtenidos", ENDPOINT['name'], record_count)
             return data if isinstance(data, list) else [data]
             
         except requests.Timeout:
@@ -178,10 +234,15 @@ class MongoDBClient:
         try:
             logger.info("Conectando a MongoDB Atlas...")
             
-            self.client = MongoClient(CONFIG['mongodb_uri'])
+            # Shared per-process client (pinged once on first use)
+            self.client = get_client(CONFIG['mongodb_uri'])
             self.db = self.client[CONFIG['mongodb_database']]
             
-            self.client.admin.command('ping')
+            # Unique index so upserts by month use a B-tree lookup and never duplicate
+            try:
+                self.db[ENDPOINT['collection']].create_index('month', unique=True)
+            except PyMongoError as e:
+                logger.warning(f"No se pudo crear el indice por mes: {e}")
             
             self.connected = True
             logger.info("Conexion a MongoDB exitosa")
@@ -191,7 +252,7 @@ class MongoDBClient:
             logger.error(f"Error de conexion a MongoDB: {e}")
             return False
     
-    def save_data(self, collection_name: str, data: List[Dict], period: str, year: int, month: int) -> bool:
+    def save_data(self, collection_name: str, data: List[Dict], period: str, year: int, month: int, keep_raw: bool = False) -> bool:
         """Save invoices data to MongoDB in the expected format"""
         try:
             if not self.connected:
@@ -204,8 +265,8 @@ class MongoDBClient:
                 logger.warning("No hay datos para guardar")
                 return False
             
-            raw_data = data[0] if len(data) == 1 else data
             invoice_data = data[0] if isinstance(data, list) and len(data) > 0 else data
+            now = datetime.now(timezone.utc)
             
             # Build document in the expected format (same as original GitHub Actions workflow)
             document = {
@@ -225,15 +286,28 @@ class MongoDBClient:
                 'discountsPercentage': invoice_data.get('discountsPercentage', 0),
                 'quantity': invoice_data.get('quantity', 0),
                 # Metadata
-                'rawData': raw_data,
-                'insertedAt': datetime.now(timezone.utc),
+                'updatedAt': now
+            }
+            
+            # Immutable metadata, only written when the month is first inserted
+            insert_only = {
+                'insertedAt': now,
                 'loadSource': 'manual'
             }
             
-            # Upsert by month field (replace if exists, insert if not)
-            result = collection.replace_one(
+            # Full rawData copies from older runs duplicated the fields above
+            update = {'$set': document, '$setOnInsert': insert_only, '$unset': {'rawData': ''}}
+            
+            # On request, keep only the payload keys that were not promoted above
+            if keep_raw:
+                document['extra'] = {k: v for k, v in invoice_data.items() if k not in document}
+            else:
+                update['$unset']['extra'] = ''
+            
+            # Upsert by month field, touching only the fields that change
+            result = collection.update_one(
                 {'month': period},
-                document,
+                update,
                 upsert=True
             )
             
@@ -256,7 +330,7 @@ class MongoDBClient:
             
             update_data = {
                 'status': status,
-                'completedAt': datetime.now(timezone.utc).isoformat()
+                'completedAt': datetime.now(timezone.utc)
             }
             
             if error:
@@ -288,7 +362,8 @@ class MongoDBClient:
     def close(self):
         """Close MongoDB connection"""
         if self.client:
-            self.client.close()
+            close_client()
+            self.client = None
             logger.info("Conexion a MongoDB cerrada")
 
 
@@ -298,12 +373,14 @@ def main():
     parser.add_argument('--year', required=True, type=int, help='Target year (e.g., 2024)')
     parser.add_argument('--month', required=True, type=int, help='Target month (1-12)')
     parser.add_argument('--job-id', type=str, default=None, help='Job ID for status tracking (optional)')
+    parser.add_argument('--keep-raw', action='store_true', help='Also store unmapped API fields in extra')
     
     args = parser.parse_args()
     
     year = args.year
     month = args.month
     job_id = args.job_id
+    keep_raw = args.keep_raw
     
     # Validate month
     if month < 1 or month > 12:
@@ -330,6 +407,10 @@ def main():
         logger.error("Requeridas: LAUDUS_PASSWORD, LAUDUS_COMPANY_VAT, MONGODB_URI")
         sys.exit(1)
     
+    if not is_valid_uri(CONFIG['mongodb_uri']):
+        logger.error("MONGODB_URI debe comenzar con mongodb:// o mongodb+srv://")
+        sys.exit(1)
+    
     # Initialize clients
     api_client = LaudusAPIClient()
     mongo_client = MongoDBClient()
@@ -349,23 +430,31 @@ def main():
     result = {'endpoint': ENDPOINT['name'], 'success': False, 'records': 0}
     attempt = 0
     max_attempts = CONFIG['max_retries']
+    data = None
     
     # Main retry loop
     while attempt < max_attempts and not completed:
         attempt += 1
         logger.info(f"--- Intento #{attempt} ---")
         
-        # Renew token every 3 attempts
-        if attempt > 1 and attempt % 3 == 1:
+        # Renew token every 3 attempts (not needed when only the MongoDB save is retried)
+        if data is None and attempt > 1 and attempt % 3 == 1:
             logger.info("Renovando token de autenticacion...")
-            if not api_client.authenticate():
+            if not api_client.authenticate(force=True):
                 logger.error("Error al renovar token")
-                time.sleep(CONFIG['retry_delay'])
+                time.sleep(get_retry_delay(attempt))
                 continue
         
-        # Fetch data
-        logger.info(f"Obteniendo {ENDPOINT['name']}...")
-        data = api_client.fetch_invoices_monthly(first_day, last_day)
+        # Fetch data (HTTP 429/5xx are already retried by the session adapter)
+        # If only the MongoDB save failed, reuse the payload from the previous attempt
+        if data is None:
+            logger.info(f"Obteniendo {ENDPOINT['name']}...")
+            data = api_client.fetch_invoices_monthly(first_day, last_day)
+            
+            # An empty payload counts as a failed fetch: wait and fetch again
+            if data is not None and not data:
+                logger.warning(f"{ENDPOINT['name']} devolvio datos vacios")
+                data = None
         
         if data is not None:
             # Save to MongoDB
@@ -374,7 +463,8 @@ def main():
                 data,
                 period,
                 year,
-                month
+                month,
+                keep_raw
             )
             
             if success:
@@ -384,14 +474,16 @@ def main():
                 logger.info(f"[OK] {ENDPOINT['name']} completado exitosamente")
                 break
             else:
+                # Empty payloads never reach save_data, so this is a MongoDB error: keep data
                 logger.error(f"[FAIL] Error al guardar en MongoDB")
         else:
             logger.error(f"[FAIL] Error al obtener {ENDPOINT['name']}")
         
-        # Wait before next attempt
+        # Wait before next attempt (a failed MongoDB save is retried with the same data)
         if attempt < max_attempts and not completed:
-            logger.info(f"Esperando {CONFIG['retry_delay']}s antes de reintentar...")
-            time.sleep(CONFIG['retry_delay'])
+            delay = get_retry_delay(attempt)
+            logger.info(f"Esperando {delay:.0f}s antes de reintentar...")
+            time.sleep(delay)
     
     # Final summary
     logger.info("")
@@ -13,8 +13,10 @@ from datetime import datetime, timezone
 from typing import Dict, List, Optional, Tuple
 import argparse
 
-from pymongo import MongoClient
-from pymongo.errors import PyMongoError
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from _mongo import get_client, close_client, is_valid_uri
 
 # Configure logging
 logging.basicConfig(
@@ -43,12 +45,10 @@ class MongoDBClient:
         try:
             logger.info("Conectando a MongoDB Atlas...")
             
-            self.client = MongoClient(CONFIG['mongodb_uri'])
+            # Shared per-process client (pinged once on first use)
+            self.client = get_client(CONFIG['mongodb_uri'])
             self.db = self.client[CONFIG['mongodb_database']]
             
-            # Test connection
-            self.client.admin.command('ping')
-            
             self.connected = True
             logger.info("Conexion a MongoDB exitosa")
             return True
@@ -80,6 +80,40 @@ class MongoDBClient:
             logger.error(f"Error leyendo de MongoDB: {e}")
             return None
             
+    def get_8columns_range(self, date_from: str, date_to: str) -> List[Dict]:
+        """Retrieve every 8-Columns Balance between two dates (inclusive) in one query"""
+        try:
+            if not self.connected:
+                raise Exception("No conectado a MongoDB")
+            
+            collection = self.db['balance_8columns']
+            
+            # _id is f"{date_str}-8Columns", so a range on _id walks the _id index in date order
+            cursor = collection.find(
+                {'_id': {'$gte': f"{date_from}-8Columns", '$lte': f"{date_to}-8Columns"}},
+                {'date': 1, 'data': 1}
+            ).sort('_id', 1)
+            
+            return list(cursor)
+            
+        except PyMongoError as e:
+            logger.error(f"Error leyendo de MongoDB: {e}")
+            return []
+    
+    @staticmethod
+    def _build_document(data: Dict, date_str: str, generated_at: datetime) -> Dict:
+        """Build the balance_general document for one date"""
+        return {
+            '_id': f"{date_str}-General",
+            'date': date_str,
+            'generatedAt': generated_at,
+            'source': 'balance_8columns',
+            'assets': data['assets'],
+            'liabilities': data['liabilities'],
+            'equity': data['equity'],
+            'totals': data['totals']
+        }
+    
     def save_balance_general(self, data: Dict, date_str: str) -> bool:
         """Save generated Balance General to MongoDB"""
         try:
@@ -88,16 +122,7 @@ class MongoDBClient:
             
             collection = self.db['balance_general']
             
-            document = {
-                '_id': f"{date_str}-General",
-                'date': date_str,
-                'generatedAt': datetime.now(timezone.utc),
-                'source': 'balance_8columns',
-                'assets': data['assets'],
-                'liabilities': data['liabilities'],
-                'equity': data['equity'],
-                'totals': data['totals']
-            }
+            document = self._build_document(data, date_str, datetime.now(timezone.utc))
             
             # Upsert
             result = collection.replace_one(
@@ -113,10 +138,55 @@ class MongoDBClient:
             logger.error(f"Error guardando en MongoDB: {e}")
             return False
     
+    def save_balance_generals(self, balances: List[Tuple[str, Dict]]) -> bool:
+        """Save several generated Balance Generals in a single bulk_write"""
+        try:
+            if not self.connected:
+                raise Exception("No conectado a MongoDB")
+            
+            if not balances:
+                return True
+            
+            collection = self.db['balance_general']
+            generated_at = datetime.now(timezone.utc)
+            
+            operations = []
+            for date_str, data in balances:
+                document = self._build_document(data, date_str, generated_at)
+                operations.append(ReplaceOne({'_id': document['_id']}, document, upsert=True))
+            
+            result = collection.bulk_write(operations, ordered=False)
+            
+            logger.info(
+                f"Balance General guardado en MongoDB para {len(operations)} fechas "
+                f"({result.upserted_count} nuevas, {result.modified_count} actualizadas)"
+            )
+            return True
+                
+        except BulkWriteError as e:
+            # Unordered: the remaining dates were still written, report which ones failed.
+            # error['index'] is the position in the submitted operations (same order as balances)
+            failed = [balances[error['index']][0] for error in e.details.get('writeErrors', [])]
+            logger.error(
+                f"Balance General guardado parcialmente: {len(failed)} fechas fallaron "
+                f"({', '.join(failed[:5])}{'...' if len(failed) > 5 else ''})"
+            )
+            return False
+        except PyMongoError as e:
+            logger.error(f"Error guardando en MongoDB: {e}")
+            return False
+    
     def close(self):
         """Close MongoDB connection"""
         if self.client:
-            self.client.close()
+            close_client()
+            self.client = None
+
+def _num(value) -> float:
+    """Numeric amount from the API: numbers pass through, None/'' become 0"""
+    if isinstance(value, (int, float)):
+        return value
+    return float(value or 0)
 
 def process_balance_sheet(source_data: List[Dict]) -> Dict:
     """
@@ -131,32 +201,38 @@ def process_balance_sheet(source_data: List[Dict]) -> Dict:
     assets = []
     liabilities = []
     
-    total_assets = 0.0
-    total_liabilities = 0.0
+    # Sums are kept in integer cents so totals are exact (no float drift)
+    total_assets_cents = 0
+    total_liabilities_cents = 0
+    total_gain_cents = 0
+    total_loss_cents = 0
     
-    for account in source_data:
+    # Sort once up front so both output lists are built already ordered by account code
+    for account in sorted(source_data, key=lambda a: a.get('accountCode') or ''):
         # The API returns fields like 'asset', 'liability', 'loss', 'gain'
         # We need to check the exact field names from the source data structure
         # Assuming standard Laudus API response structure based on previous context
         
-        asset_val = float(account.get('asset', 0) or 0)
-        liability_val = float(account.get('liability', 0) or 0)
+        asset_cents = round(_num(account.get('asset')) * 100)
+        liability_cents = round(_num(account.get('liability')) * 100)
+        total_gain_cents += round(_num(account.get('gain')) * 100)
+        total_loss_cents += round(_num(account.get('loss')) * 100)
         
-        if asset_val > 0:
+        if asset_cents > 0:
             assets.append({
                 'accountCode': account.get('accountCode'),
                 'accountName': account.get('accountName'),
-                'amount': asset_val
+                'amount': asset_cents / 100
             })
-            total_assets += asset_val
+            total_assets_cents += asset_cents
             
-        if liability_val > 0:
+        if liability_cents > 0:
             liabilities.append({
                 'accountCode': account.get('accountCode'),
                 'accountName': account.get('accountName'),
-                'amount': liability_val
+                'amount': liability_cents / 100
             })
-            total_liabilities += liability_val
+            total_liabilities_cents += liability_cents
             
     # Calculate Result (Profit/Loss)
     # In the 8-column balance, the difference between Assets and Liabilities 
@@ -168,7 +244,19 @@ def process_balance_sheet(source_data: List[Dict]) -> Dict:
     # Equity = Capital + Reserves + Result
     # So Result = Assets - Liabilities (pure accounting equation)
     
-    result_of_exercise = total_assets - total_liabilities
+    result_cents = total_assets_cents - total_liabilities_cents
+    
+    # Independent invariant of the 8-column balance: Activo - Pasivo = Ganancia - Perdida
+    if abs((total_gain_cents - total_loss_cents) - result_cents) >= 100:
+        logger.warning(
+            f"Descuadre en Balance de 8 Columnas: Ganancia - Perdida = "
+            f"{(total_gain_cents - total_loss_cents) / 100:,.2f}, "
+            f"Activo - Pasivo = {result_cents / 100:,.2f}"
+        )
+    
+    total_assets = total_assets_cents / 100
+    total_liabilities = total_liabilities_cents / 100
+    result_of_exercise = result_cents / 100
     
     equity = []
     
@@ -204,32 +292,75 @@ def process_balance_sheet(source_data: List[Dict]) -> Dict:
     # The 'result_of_exercise' is added to make it balance perfectly if not already included.
     
     return {
-        'assets': sorted(assets, key=lambda x: x['accountCode']),
-        'liabilities': sorted(liabilities, key=lambda x: x['accountCode']), # This is technically Liabilities + Equity
+        'assets': assets,
+        'liabilities': liabilities, # This is technically Liabilities + Equity
         'equity': equity, # This contains the calculated result
         'totals': {
             'total_assets': total_assets,
             'total_liabilities': total_liabilities,
-            'total_equity': total_equity,
-            'balance_check': total_assets - (total_liabilities + total_equity) # Should be 0
+            'total_equity': total_equity
         }
     }
 
+def generate_range(mongo_client: MongoDBClient, date_from: str, date_to: str):
+    """Generate the Balance General for every stored date in a range over one connection"""
+    # The transform is a single pass over a few hundred accounts per date, so it
+    # runs in-process: the cost is the Mongo round trips, which are batched here
+    logger.info("Obteniendo datos de Balance de 8 Columnas...")
+    source_docs = mongo_client.get_8columns_range(date_from, date_to)
+    
+    if not source_docs:
+        logger.error("No se pudo generar el Balance General: Faltan datos origen")
+        sys.exit(1)
+    
+    logger.info(f"Fechas con datos origen: {len(source_docs)}")
+    
+    balances = []
+    for source_doc in source_docs:
+        date_str = source_doc.get('date') or source_doc['_id'][:-len('-8Columns')]
+        balance_general = process_balance_sheet(source_doc.get('data', []))
+        logger.info(
+            f"{date_str}: {len(balance_general['assets'])} activos, "
+            f"{len(balance_general['liabilities'])} pasivos, "
+            f"resultado {balance_general['totals']['total_equity']:,.2f}"
+        )
+        balances.append((date_str, balance_general))
+    
+    logger.info("Guardando Balance General...")
+    if mongo_client.save_balance_generals(balances):
+        logger.info("Proceso completado exitosamente")
+    else:
+        logger.error("Error al guardar los datos")
+        sys.exit(1)
+
 def main():
     parser = argparse.ArgumentParser(description='Generate Balance General from 8-Columns Balance')
-    parser.add_argument('--date', required=True, help='Target date in YYYY-MM-DD format')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--date', help='Target date in YYYY-MM-DD format')
+    group.add_argument('--date-from', help='First date of a range in YYYY-MM-DD format')
+    parser.add_argument('--date-to', help='Last date of the range in YYYY-MM-DD format (default: --date-from)')
     
     args = parser.parse_args()
     target_date = args.date
     
+    if args.date_to and not args.date_from:
+        parser.error('--date-to requires --date-from')
+    
     logger.info("=" * 60)
     logger.info("  GENERACION DE BALANCE GENERAL")
     logger.info("=" * 60)
-    logger.info(f"Fecha: {target_date}")
+    if target_date:
+        logger.info(f"Fecha: {target_date}")
+    else:
+        logger.info(f"Rango: {args.date_from} a {args.date_to or args.date_from}")
     
     if not CONFIG['mongodb_uri']:
         logger.error("Falta variable de entorno MONGODB_URI")
         sys.exit(1)
+    
+    if not is_valid_uri(CONFIG['mongodb_uri']):
+        logger.error("MONGODB_URI debe comenzar con mongodb:// o mongodb+srv://")
+        sys.exit(1)
         
     mongo_client = MongoDBClient()
     
@@ -237,6 +368,10 @@ def main():
         sys.exit(1)
         
     try:
+        if not target_date:
+            generate_range(mongo_client, args.date_from, args.date_to or args.date_from)
+            return
+        
         # 1. Get 8-Columns Data
         logger.info("Obteniendo datos de Balance de 8 Columnas...")
         source_doc = mongo_client.get_8columns_data(target_date)
@@ -255,7 +390,6 @@ def main():
         logger.info(f"Activos: {len(balance_general['assets'])}")
         logger.info(f"Pasivos (+Patrimonio): {len(balance_general['liabilities'])}")
         logger.info(f"Resultado del Ejercicio: {balance_general['totals']['total_equity']:,.2f}")
-        logger.info(f"Check de Balance: {balance_general['totals']['balance_check']}")
         
         # 3. Save Data
         logger.info("Guardando Balance General...")